@@ -1,20 +1,40 @@
 # AILogListener.py
 import os, traceback
+from concurrent.futures import ThreadPoolExecutor
 from robot.api import logger
+from robot.utils import normalize
 from ai_client import _chat
 
 class AILogListener:
     ROBOT_LISTENER_API_VERSION = 3
 
-    def __init__(self, model=None, tags="AI_ANALYZE", max_chars="4000"):
+    def __init__(self, model=None, tags="AI_ANALYZE", max_chars="4000", max_steps="10", workers="2"):
         self.model = model or os.getenv("OLLAMA_MODEL", "gpt-oss:20b-cloud")
-        self.enabled_tags = set([t.strip() for t in (tags or "").split(",") if t.strip()])
+        self.enabled_tags = frozenset(self._normalize_tag(t) for t in (tags or "").split(",") if t.strip())
         self.max_chars = int(max_chars)
+        self.max_steps = int(max_steps)
+        # LLM calls run in the background so failures don't stall the run;
+        # results are reported from Robot's main thread in end_suite/close.
+        workers = int(workers)
+        if workers < 1:
+            raise ValueError(f"AILogListener workers must be at least 1, got {workers}.")
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ai-listener")
+        self._pending = []
+
+    @staticmethod
+    def _normalize_tag(tag):
+        # Same rules as Robot's own tag matching: ignore case, spaces and underscores
+        return normalize(tag, ignore=("_",))
 
     def _should_analyze(self, result):
         if not self.enabled_tags:
             return True
-        return any(t in self.enabled_tags for t in result.tags)
+        return any(self._normalize_tag(t) in self.enabled_tags for t in result.tags)
+
+    @staticmethod
+    def _format_step(kw):
+        # result-model keyword: always has name, args and status
+        return f"{kw.name}  {'  '.join(str(a) for a in kw.args)}  -> {kw.status}"
 
     def end_test(self, data, result):
         try:
@@ -23,24 +43,32 @@ class AILogListener:
             if not self._should_analyze(result):
                 return
 
-            # Gather minimal context: test name, message, steps
+            # Gather minimal context: test name, message, last few steps.
+            # Walk result.body (running keywords carry no status) backwards and
+            # stop once enough steps are found; only those get formatted.
             steps = []
-            for item in getattr(data, "body", []):
-                kw = getattr(item, "kwname", None)
-                args = getattr(item, "args", [])
-                status = getattr(item, "status", "")
-                if kw:
-                    steps.append(f"{kw}  {'  '.join(map(str, args))}  -> {status}")
+            for item in reversed(result.body):
+                if len(steps) >= self.max_steps:
+                    break
+                if item.type != "KEYWORD":
+                    continue
+                steps.append(self._format_step(item))
+            steps.reverse()
+
+            msg = result.message or ""
+            if len(msg) > self.max_chars:
+                msg = msg[-self.max_chars:]
 
             failure_text = f"""
 Test: {result.longname}
-Error: {result.message}
+Error: {msg}
 Elapsed: {result.elapsedtime} ms
 Tags: {', '.join(result.tags)}
 Steps:
 - """ + "\n- ".join(steps)
 
-            failure_text = failure_text[-self.max_chars:]  # keep prompt bounded
+            if len(failure_text) > self.max_chars:
+                failure_text = failure_text[-self.max_chars:]  # keep prompt bounded
 
             messages = [
                 {"role":"system","content":
@@ -49,9 +77,33 @@ Steps:
                  "Be concise, bullet-pointed. Avoid generic advice."},
                 {"role":"user","content": failure_text}
             ]
-            analysis = _chat(messages, model=self.model, temperature=0.2)
-            logger.console("\n=== AI Failure Analysis ===\n" + analysis + "\n===========================\n")
-            logger.warn("AI analysis:\n" + analysis)  # also visible in log.html
+            future = self._pool.submit(_chat, messages, model=self.model, temperature=0.2)
+            self._pending.append((result.longname, future))
         except Exception as e:
             logger.warn("AI listener failed: " + repr(e))
             logger.debug(traceback.format_exc())
+
+    def end_suite(self, data, result):
+        # Report finished analyses as we go; wait for the rest at the top level
+        # so they still land in the output before it is written.
+        self._report(wait=data.parent is None)
+
+    def close(self):
+        self._report(wait=True)
+        self._pool.shutdown()
+
+    def _report(self, wait):
+        still_pending = []
+        for longname, future in self._pending:
+            if not wait and not future.done():
+                still_pending.append((longname, future))
+                continue
+            try:
+                analysis = future.result()
+            except Exception as e:
+                logger.warn(f"AI listener failed for '{longname}': {e!r}")
+                logger.debug("".join(traceback.format_exception(type(e), e, e.__traceback__)))
+                continue
+            logger.console(f"\n=== AI Failure Analysis: {longname} ===\n" + analysis + "\n===========================\n")
+            logger.warn(f"AI analysis for '{longname}':\n" + analysis)  # also visible in log.html
+        self._pending = still_pending
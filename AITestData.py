@@ -1,41 +1,153 @@
 # AITestData.py
+import os, json
+from robot.api import logger
 from robot.api.deco import keyword, library
-from ai_client import json_reply
+from ai_client import cache_reply, json_reply, json_reply_many
 
-@library
+try:
+    import fastjsonschema  # optional: validate model output against the schema
+except ImportError:
+    fastjsonschema = None
+
+_SCHEMAS = {
+    "user_profile": {
+        "type": "object",
+        "properties": {
+            "first_name": {"type":"string"},
+            "last_name": {"type":"string"},
+            "email": {"type":"string"},
+            "phone": {"type":"string"},
+            "password": {"type":"string"},
+            "country": {"type":"string"}
+        },
+        "required": ["first_name","last_name","email","password"]
+    }
+}
+# Serialized once: the prompt gets real JSON instead of a Python dict repr
+_SCHEMAS_JSON = {name: json.dumps(schema, separators=(",", ":")) for name, schema in _SCHEMAS.items()}
+_DEFAULT_JSON = '{"type":"object"}'
+# Compiled once at import; validating each reply is then a plain function call
+_VALIDATORS = {name: fastjsonschema.compile(schema) for name, schema in _SCHEMAS.items()} if fastjsonschema else {}
+
+_SYSTEM_PROMPT = (
+    "You generate realistic test data for automated tests. "
+    "Follow the schema, fill plausible values, keep it deterministic-ish, and DO NOT include secrets."
+)
+
+def _user_prompt(type, constraints):
+    schema_json = _SCHEMAS_JSON.get(type, _DEFAULT_JSON)
+    # sort_keys keeps the prompt (and its cache key) stable across kwarg order
+    constraints_json = json.dumps(constraints, sort_keys=True, default=str)
+    return (
+        f"Generate one {type} object as JSON matching this JSON Schema:\n"
+        f"{schema_json}\n"
+        f"Constraints (optional): {constraints_json}\n"
+        f"Keep values simple and test-friendly."
+    )
+
+def _batch_prompt(base, index, n):
+    # Numbered so each record of a batch is a distinct (cacheable) prompt
+    return f"{base}\nThis is record {index} of {n}; make it distinct from the others."
+
+@library(scope="GLOBAL")
 class AITestData:
+    __slots__ = ("model",)
+
     def __init__(self, model=None):
         self.model = model
 
     @keyword("Generate Test Data")
-    def generate_test_data(self, type="user_profile", **constraints):
+    def generate_test_data(self, type="user_profile", fresh=False, **constraints):
         """
         Example: ${user}=  Generate Test Data  type=user_profile  country=AT  password_policy=strong
         Returns a Python dict.
+        Replies are cached for the run: calls with the same type and
+        constraints return the same record (e.g. the same email). Pass
+        fresh=True for a new record from the model, or use
+        Generate Test Data Batch for several distinct ones.
+        """
+        # Semantic cache (AI_SEMCACHE=1) compares only the constraints, per type
+        semantic = (type, ", ".join(f"{k}={v}" for k, v in sorted(constraints.items())))
+        return json_reply(_SYSTEM_PROMPT, _user_prompt(type, constraints), model=self.model,
+                          validator=_VALIDATORS.get(type), semantic=semantic, cache=not fresh)
+
+    @keyword("Generate Test Data Batch")
+    def generate_test_data_batch(self, n=10, type="user_profile", **constraints):
         """
-        system = (
-            "You generate realistic test data for automated tests. "
-            "Follow the schema, fill plausible values, keep it deterministic-ish, and DO NOT include secrets."
-        )
-        schema_by_type = {
-            "user_profile": {
-                "type": "object",
-                "properties": {
-                    "first_name": {"type":"string"},
-                    "last_name": {"type":"string"},
-                    "email": {"type":"string"},
-                    "phone": {"type":"string"},
-                    "password": {"type":"string"},
-                    "country": {"type":"string"}
-                },
-                "required": ["first_name","last_name","email","password"]
-            }
-        }
-        schema = schema_by_type.get(type, {"type":"object"})
-        user_prompt = (
-            f"Generate one {type} object as JSON matching this JSON Schema:\n"
-            f"{schema}\n"
-            f"Constraints (optional): {constraints}\n"
-            f"Keep values simple and test-friendly."
-        )
-        return json_reply(system, user_prompt, model=self.model)
+        Example: @{users}=  Generate Test Data Batch  5  type=user_profile  country=AT
+        Returns a list of n dicts, requested from the model concurrently.
+        """
+        n = int(n)
+        base = _user_prompt(type, constraints)
+        pairs = [(_SYSTEM_PROMPT, _batch_prompt(base, i, n)) for i in range(1, n + 1)]
+        return json_reply_many(pairs, model=self.model, validator=_VALIDATORS.get(type))
+
+    @keyword("Preload Test Data")
+    def preload_test_data(self, path):
+        """
+        Example: Preload Test Data  ${CURDIR}/fixtures/users.jsonl
+        Seeds the reply cache from a JSON-lines fixture so matching
+        Generate Test Data calls never reach the model. One record per line:
+        {"type": "user_profile", "constraints": {"country": "AT"}, "data": {...}}
+        Records for Generate Test Data Batch also carry "index" (1-based)
+        and "n", the batch size they were generated for.
+        Preloaded records are never evicted from the cache.
+        Returns the number of distinct records loaded.
+        """
+        count = duplicates = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                user_prompt = _user_prompt(record.get("type", "user_profile"), record.get("constraints") or {})
+                if "n" in record:
+                    user_prompt = _batch_prompt(user_prompt, int(record["index"]), int(record["n"]))
+                if cache_reply(_SYSTEM_PROMPT, user_prompt, record["data"], model=self.model):
+                    count += 1
+                else:
+                    duplicates += 1
+        if duplicates:
+            logger.warn(f"Preload Test Data: {duplicates} record(s) in {path} repeat an earlier "
+                        f"type/constraints combination; only the last one of each is used.")
+        return count
+
+def _warmup(argv=None):
+    """
+    Append generated records to a Preload Test Data fixture, e.g.
+      python AITestData.py type=user_profile country=AT -o fixtures/users.jsonl
+      python AITestData.py type=user_profile country=AT -n 5 -o fixtures/users.jsonl
+    With -n, the records match 'Generate Test Data Batch  5  ...' instead.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate fixture records for 'Preload Test Data'.")
+    parser.add_argument("fields", nargs="*", metavar="key=value", help="type=... plus keyword constraints")
+    parser.add_argument("-o", "--output", required=True, help="JSON-lines fixture file to append to")
+    parser.add_argument("-n", type=int, help="generate a batch of N records for Generate Test Data Batch")
+    parser.add_argument("--model", help="defaults to OLLAMA_MODEL")
+    args = parser.parse_args(argv)
+
+    bad = [field for field in args.fields if "=" not in field]
+    if bad:
+        parser.error(f"expected key=value, got: {' '.join(bad)}")
+    if args.n is not None and args.n < 1:
+        parser.error("-n must be at least 1")
+    constraints = dict(field.split("=", 1) for field in args.fields)
+    type = constraints.pop("type", "user_profile")
+
+    lib = AITestData(args.model)
+    if args.n is None:
+        records = [{"type": type, "constraints": constraints, "data": lib.generate_test_data(type, **constraints)}]
+    else:
+        batch = lib.generate_test_data_batch(args.n, type, **constraints)
+        records = [{"type": type, "constraints": constraints, "index": i, "n": args.n, "data": data}
+                   for i, data in enumerate(batch, start=1)]
+    out_dir = os.path.dirname(args.output)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    with open(args.output, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+if __name__ == "__main__":
+    _warmup()
@@ -1,33 +1,76 @@
 # ai_client.py
-import os, json, re, requests
+import os, json, copy, hashlib, threading, requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from requests import HTTPError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional, much faster (de)serialization
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _loads = orjson.loads
+    _dumps_bytes = orjson.dumps
+else:
+    _loads = json.loads
+    def _dumps_bytes(obj):
+        return json.dumps(obj).encode("utf-8")
+
+def _dumps(obj):
+    return _dumps_bytes(obj).decode("utf-8")
 
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434").rstrip("/")
 MODEL = os.getenv("OLLAMA_MODEL", "gpt-oss:20b-cloud")  # your model
 TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "120"))
+MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))  # json_reply_many workers
+
+# One pooled keep-alive session for the whole process instead of a fresh
+# connection (TCP + TLS handshake) per requests.post call.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=32,
+    # A generation that may have reached Ollama must never be re-sent (it
+    # would queue another job): read=False surfaces ReadTimeout directly,
+    # and 502/504 are not retried since a gateway can return them after
+    # forwarding the request. Only connect errors and 503 (Ollama busy,
+    # request rejected before scheduling) are retried.
+    max_retries=Retry(total=2, read=False, backoff_factor=0.2, status_forcelist=[503],
+                      allowed_methods=frozenset({"POST"}), raise_on_status=False),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update({"Content-Type": "application/json"})
 
 def _post_json(url, payload):
-    r = requests.post(url, json=payload, timeout=TIMEOUT)
+    # Serialize ourselves so requests doesn't run its own json.dumps
+    r = SESSION.post(url, data=_dumps_bytes(payload), timeout=TIMEOUT)
     try:
         r.raise_for_status()
     except HTTPError as e:
         body = ""
         try: body = f" | server said: {r.text[:500]}"
         except Exception: pass
-        raise HTTPError(f"{e} (model={payload.get('model')}){body}") from e
+        raise HTTPError(f"{e} (model={payload.get('model')}){body}", response=r) from e
     return r
 
 def _messages_to_prompt(messages):
-    sys = "\n".join(m["content"] for m in messages if m.get("role") == "system")
-    convo = []
+    sys_parts = []
+    parts = []
     for m in messages:
         role = m.get("role")
-        if role == "user":
-            convo.append(f"User: {m['content']}")
+        if role == "system":
+            sys_parts.append(m["content"])
+        elif role == "user":
+            parts += ("User: ", m["content"], "\n")
         elif role == "assistant":
-            convo.append(f"Assistant: {m['content']}")
-    convo.append("Assistant:")
-    return (f"[System]\n{sys}\n\n" if sys else "") + "\n".join(convo)
+            parts += ("Assistant: ", m["content"], "\n")
+    parts.append("Assistant:")
+    sys = "\n".join(sys_parts)
+    return ("[System]\n" + sys + "\n\n" if sys else "") + "".join(parts)
 
 def _extract_from_harmony_message(message_obj):
     """
@@ -40,24 +83,26 @@ def _extract_from_harmony_message(message_obj):
     if isinstance(content, str):
         return content
     if isinstance(content, list):
-        first_json = None
+        # Single pass: the first JSON block wins outright, so return as soon
+        # as it is seen; text is only needed when there is no JSON block.
         texts = []
+        want_json = True
         for part in content:
             if not isinstance(part, dict):
                 continue
-            if "json" in part and first_json is None:
-                first_json = part["json"]
+            if want_json:
+                first_json = part.get("json")
+                if first_json is not None:
+                    # return as a JSON string for downstream parser
+                    try:
+                        return _dumps(first_json)
+                    except Exception:
+                        want_json = False
             # common text carriers
             if "text" in part:
                 texts.append(str(part["text"]))
-            elif part.get("type") in ("output_text", "text") and "content" in part:
+            elif "content" in part and part.get("type") in ("output_text", "text"):
                 texts.append(str(part["content"]))
-        if first_json is not None:
-            # return as a JSON string for downstream parser
-            try:
-                return json.dumps(first_json)
-            except Exception:
-                pass
         if texts:
             return "".join(texts)
     # Some servers put text at top-level keys too
@@ -83,77 +128,321 @@ def _extract_text_or_json(data):
             if isinstance(c, list):  # Harmony-style list at top level
                 return _extract_from_harmony_message({"content": c})
     # Last resort: stringify
-    return json.dumps(data)
+    return _dumps(data)
+
+# (host, model) -> "chat" | "generate": the endpoint that last worked
+_ENDPOINT_CACHE = {}
+
+_CHAT_URL = f"{OLLAMA_HOST}/api/chat"
+_GEN_URL = f"{OLLAMA_HOST}/api/generate"
+# Shared options for the default temperature; never mutated. (Plain dicts,
+# since MappingProxyType isn't JSON serializable.)
+_OPTIONS_DEFAULT = {"temperature": 0.2}
+_OPTIONS_DEFAULT_JSON = {"temperature": 0.2, "format": "json"}
 
 def _chat(messages, model=None, temperature=0.2, json_mode=False):
     """
-    Try /api/chat first. On 404/501, fallback to /api/generate.
+    Try /api/chat first. On 404/501, fallback to /api/generate and keep
+    using it for that host/model on later calls.
     If json_mode=True, ask for JSON via options.format='json' (ignored by some models).
     """
     use_model = model or MODEL
-    options = {"temperature": temperature}
-    if json_mode:
-        # Supported by many Ollama backends; ignored by some (including gpt-oss in Harmony).
-        options["format"] = "json"
+    # format=json is supported by many Ollama backends; ignored by some (including gpt-oss in Harmony).
+    if temperature == 0.2:
+        options = _OPTIONS_DEFAULT_JSON if json_mode else _OPTIONS_DEFAULT
+    else:
+        options = {"temperature": temperature}
+        if json_mode:
+            options["format"] = "json"
+    endpoint_key = (OLLAMA_HOST, use_model)
 
-    # 1) chat
-    try:
-        url = f"{OLLAMA_HOST}/api/chat"
-        payload = {
-            "model": use_model,
-            "messages": messages,
-            "stream": False,
-            "options": options,
-        }
-        r = _post_json(url, payload)
-        return _extract_text_or_json(r.json())
-    except HTTPError as e:
-        code = getattr(e.response, "status_code", None)
-        if code not in (404, 501):
-            # Real error (incl "model not found") -> bubble up
-            raise
+    # 1) chat, unless this backend already proved it only speaks /api/generate
+    if _ENDPOINT_CACHE.get(endpoint_key) != "generate":
+        try:
+            payload = {
+                "model": use_model,
+                "messages": messages,
+                "stream": False,
+                "options": options,
+            }
+            r = _post_json(_CHAT_URL, payload)
+            _ENDPOINT_CACHE[endpoint_key] = "chat"
+            return _extract_text_or_json(_loads(r.content))
+        except HTTPError as e:
+            code = getattr(e.response, "status_code", None)
+            if code not in (404, 501):
+                # Real error (incl "model not found") -> bubble up
+                raise
 
     # 2) generate (fallback)
     prompt = _messages_to_prompt(messages)
-    gen_url = f"{OLLAMA_HOST}/api/generate"
     gen_payload = {
         "model": use_model,
         "prompt": prompt,
         "stream": False,
         "options": options,
     }
-    r = _post_json(gen_url, gen_payload)
-    return _extract_text_or_json(r.json())
+    r = _post_json(_GEN_URL, gen_payload)
+    # Only remember the fallback once it has actually worked
+    _ENDPOINT_CACHE[endpoint_key] = "generate"
+    return _extract_text_or_json(_loads(r.content))
 
 # ---------- JSON helpers ----------
 
-_JSON_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE | re.DOTALL)
-_FIRST_JSON = re.compile(r"(\{.*\}|\[.*\])", re.DOTALL)
+def _strip_fences(s):
+    """
+    Remove a leading ```/```json and trailing ``` fence, if present.
+    """
+    s = s.strip()
+    if s.startswith("```"):
+        s = s[3:]
+        if s[:4].lower() == "json":
+            s = s[4:]
+        s = s.lstrip()
+    if s.endswith("```"):
+        s = s[:-3].rstrip()
+    return s
+
+_JSON_DECODER = json.JSONDecoder()
+_MAX_JSON_CANDIDATES = 64  # decode attempts on balanced blocks; bounds pathological chatter
+
+def _json_object_starts(s):
+    """
+    Return the start index of every balanced {...} block in s, in order.
+    One linear pass with a stack of open-brace positions; quotes only count
+    inside a block, so braces inside JSON strings are ignored while prose
+    apostrophes/quotes around the JSON are not mistaken for strings.
+    """
+    stack = []
+    starts = []
+    in_string = escape = False
+    for i, ch in enumerate(s):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = bool(stack)
+        elif ch == "{":
+            stack.append(i)
+        elif ch == "}" and stack:
+            starts.append(stack.pop())
+    starts.sort()
+    return starts
 
 def _coerce_json(s: str):
     """
     1) strip ```json fences
-    2) if it's already valid JSON -> parse
-    3) else find the first {...} or [...] block and parse
+    2) if it looks like JSON -> parse
+    3) else parse the first balanced {...} object that is valid JSON
     """
     if not isinstance(s, str):
         return s  # maybe already a dict/list
-    candidate = _JSON_FENCE.sub("", s.strip())
+    candidate = _strip_fences(s)
+    if candidate[:1] in ("{", "["):
+        try:
+            return _loads(candidate)
+        except Exception:
+            pass
+    # Outermost blocks come first; raw_decode parses in place without slicing
+    for start in _json_object_starts(candidate)[:_MAX_JSON_CANDIDATES]:
+        try:
+            return _JSON_DECODER.raw_decode(candidate, start)[0]
+        except (ValueError, RecursionError):
+            pass  # e.g. "{placeholder}" chatter or absurd nesting; try the next block
+    raise ValueError(f"Model did not return JSON.\nFirst 500 chars:\n{candidate[:500]}")
+
+# ---------- reply cache ----------
+
+_CACHE_MAX = int(os.getenv("AI_CACHE_MAX", "512"))  # 0 disables the cache
+OFFLINE = os.getenv("AI_OFFLINE", "0") == "1"  # CI: cache misses raise instead of calling the model
+_REPLY_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()  # json_reply_many calls in from worker threads
+# Preloaded fixture replies (cache_reply): checked first, never evicted and
+# kept even when AI_CACHE_MAX=0, so AI_OFFLINE runs can rely on them.
+_PINNED = {}
+_MISS = object()
+
+def _cache_key(model, system_prompt, user_prompt, temperature, json_mode):
+    raw = json.dumps([model, system_prompt, user_prompt, temperature, json_mode], sort_keys=True)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def _cache_get(key):
+    """
+    Return a copy of the cached reply (callers may mutate it), or _MISS.
+    """
+    with _CACHE_LOCK:
+        value = _PINNED.get(key, _MISS)
+        if value is _MISS:
+            value = _REPLY_CACHE.get(key, _MISS)
+            if value is _MISS:
+                return _MISS
+            _REPLY_CACHE.move_to_end(key)
+    return copy.deepcopy(value)
+
+def _cache_put(key, value):
+    if _CACHE_MAX <= 0:
+        return
+    value = copy.deepcopy(value)
+    with _CACHE_LOCK:
+        _REPLY_CACHE[key] = value
+        _REPLY_CACHE.move_to_end(key)
+        while len(_REPLY_CACHE) > _CACHE_MAX:
+            _REPLY_CACHE.popitem(last=False)
+
+# ---------- semantic cache (opt-in) ----------
+
+SEMCACHE = os.getenv("AI_SEMCACHE", "0") == "1"
+SEMCACHE_THRESHOLD = float(os.getenv("AI_SEMCACHE_THRESHOLD", "0.95"))
+EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")
+if SEMCACHE:
     try:
-        return json.loads(candidate)
-    except Exception:
-        m = _FIRST_JSON.search(candidate)
-        if m:
-            return json.loads(m.group(1))
-        raise ValueError(f"Model did not return JSON.\nFirst 500 chars:\n{candidate[:500]}")
+        import numpy as np  # optional: only needed for the semantic cache
+    except ImportError:
+        from robot.api import logger
+        logger.warn("AI_SEMCACHE=1 needs numpy, which is not installed; semantic cache disabled.")
+        SEMCACHE = False
+
+_EMBED_URL = f"{OLLAMA_HOST}/api/embeddings"
+# (model, system_prompt, caller scope) -> (matrix of unit-length embeddings, [replies])
+_SEM_CACHE = {}
 
-def json_reply(system_prompt, user_prompt, model=None):
+def _embed(text):
+    r = _post_json(_EMBED_URL, {"model": EMBED_MODEL, "prompt": text})
+    vec = np.asarray(_loads(r.content)["embedding"], dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+def _semcache_get(scope, vec):
+    with _CACHE_LOCK:
+        entry = _SEM_CACHE.get(scope)
+    if entry is None:
+        return _MISS
+    matrix, replies = entry
+    if matrix.shape[1] != vec.shape[0]:
+        return _MISS  # embedding model changed dimension; not comparable
+    sims = matrix @ vec  # cosine similarity, rows are already normalized
+    best = int(sims.argmax())
+    if sims[best] < SEMCACHE_THRESHOLD:
+        return _MISS
+    return copy.deepcopy(replies[best])
+
+def _semcache_put(scope, vec, value):
+    if _CACHE_MAX <= 0:
+        return
+    value = copy.deepcopy(value)
+    with _CACHE_LOCK:
+        entry = _SEM_CACHE.get(scope)
+        if entry is None:
+            matrix, replies = vec[None, :], [value]
+        elif entry[0].shape[1] != vec.shape[0]:
+            return  # keep the scope's matrix consistent; don't mix dimensions
+        else:
+            matrix, replies = np.vstack([entry[0], vec]), entry[1] + [value]
+        if len(replies) > _CACHE_MAX:
+            matrix, replies = matrix[1:], replies[1:]
+        _SEM_CACHE[scope] = (matrix, replies)
+
+def json_reply(system_prompt, user_prompt, model=None, validator=None, semantic=None, cache=True):
     """
     Ask model for STRICT JSON. Harmony-aware extraction + fallbacks.
+    Identical requests are answered from an in-process LRU cache.
+    validator: optional callable that raises if the parsed reply is not
+    acceptable; the model gets one retry and invalid replies are never cached.
+    semantic: optional (scope, text) for the AI_SEMCACHE layer. Only `text`,
+    the variable part of the prompt, is embedded, and replies are only reused
+    within the same scope (plus model and system prompt). Without it the
+    semantic layer is skipped: embedding a whole templated prompt makes
+    prompts that differ in a few characters look identical.
+    cache: False always asks the model (no cache lookup, reply not stored),
+    for callers that need a new record each time.
     """
+    use_model = model or MODEL
+    key = _cache_key(use_model, system_prompt, user_prompt, 0.2, True)
+    cached = _cache_get(key) if cache else _MISS
+    if cached is not _MISS:
+        return cached
+
+    # Only live model replies fill the semantic cache, so offline it can
+    # never hit; don't spend an embeddings request before failing.
+    if OFFLINE:
+        raise RuntimeError(
+            "AI_OFFLINE=1 and no cached reply for this prompt; "
+            "preload fixtures with 'Preload Test Data' or unset AI_OFFLINE.\n"
+            f"First 500 chars of prompt:\n{user_prompt[:500]}"
+        )
+
+    # Differently phrased but equivalent requests can reuse a reply when
+    # AI_SEMCACHE=1; an embedding failure just skips this layer.
+    # Nothing variable to compare (no constraints) or an empty embedding
+    # (Ollama's answer to an empty prompt) also skips it.
+    vec = None
+    if cache and SEMCACHE and semantic is not None and semantic[1]:
+        scope = (use_model, system_prompt, semantic[0])
+        try:
+            vec = _embed(semantic[1])
+        except Exception:
+            vec = None
+        if vec is not None and vec.size == 0:
+            vec = None
+        if vec is not None:
+            cached = _semcache_get(scope, vec)
+            if cached is not _MISS:
+                _cache_put(key, cached)
+                return cached
+
     messages = [
         {"role": "system", "content": f"{system_prompt}\nReturn ONLY valid JSON."},
         {"role": "user", "content": user_prompt},
     ]
-    content = _chat(messages, model=model, temperature=0.2, json_mode=True)
-    return _coerce_json(content)
+    content = _chat(messages, model=use_model, temperature=0.2, json_mode=True)
+    data = _coerce_json(content)
+    if validator is not None:
+        try:
+            validator(data)
+        except Exception as e:
+            # One retry, telling the model why the first reply was rejected
+            messages[1] = {
+                "role": "user",
+                "content": f"{user_prompt}\nYour previous reply was rejected ({e}). Return must validate against the schema.",
+            }
+            content = _chat(messages, model=use_model, temperature=0.2, json_mode=True)
+            data = _coerce_json(content)
+            validator(data)
+    if cache:
+        _cache_put(key, data)
+    if vec is not None:
+        _semcache_put(scope, vec, data)
+    return data
+
+def cache_reply(system_prompt, user_prompt, value, model=None):
+    """
+    Pin value so json_reply(system_prompt, user_prompt, model) returns it
+    without calling the model (used for fixture preloading). Pinned replies
+    are never evicted. Returns False if it replaced an earlier pinned reply.
+    """
+    key = _cache_key(model or MODEL, system_prompt, user_prompt, 0.2, True)
+    value = copy.deepcopy(value)
+    with _CACHE_LOCK:
+        is_new = key not in _PINNED
+        _PINNED[key] = value
+    return is_new
+
+def json_reply_many(pairs, model=None, validator=None):
+    """
+    Run json_reply for each (system_prompt, user_prompt) pair concurrently
+    over the pooled session (Ollama batches concurrent requests itself).
+    Results keep the input order. The semantic cache is never used: batch
+    prompts are near-identical on purpose and must each get their own reply.
+    """
+    pairs = list(pairs)
+    if len(pairs) <= 1:
+        return [json_reply(system, user, model=model, validator=validator, semantic=None)
+                for system, user in pairs]
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(pairs))) as pool:
+        futures = [pool.submit(json_reply, system, user, model=model, validator=validator, semantic=None)
+                   for system, user in pairs]
+        return [f.result() for f in futures]
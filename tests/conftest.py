@@ -0,0 +1,45 @@
+# tests/conftest.py
+import os, sys
+import pytest
+
+# The libraries live at the repo root (Robot imports them by path)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ai_client
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    """Fresh caches, online mode, and no real HTTP unless a test stubs it."""
+    monkeypatch.setattr(ai_client, "_REPLY_CACHE", ai_client.OrderedDict())
+    monkeypatch.setattr(ai_client, "_PINNED", {})
+    monkeypatch.setattr(ai_client, "_SEM_CACHE", {})
+    monkeypatch.setattr(ai_client, "_ENDPOINT_CACHE", {})
+    monkeypatch.setattr(ai_client, "OFFLINE", False)
+    monkeypatch.setattr(ai_client, "SEMCACHE", False)
+
+    def no_network(*args, **kwargs):
+        raise AssertionError("unexpected HTTP request")
+    monkeypatch.setattr(ai_client.SESSION, "post", no_network)
+
+
+class FakeChat:
+    """Stand-in for ai_client._chat: records messages, returns queued replies
+    (or, when none are queued, a JSON object echoing the user prompt)."""
+
+    def __init__(self):
+        self.calls = []
+        self.replies = []
+
+    def __call__(self, messages, model=None, temperature=0.2, json_mode=False):
+        self.calls.append(messages)
+        if self.replies:
+            return self.replies.pop(0)
+        return ai_client._dumps({"prompt": messages[-1]["content"]})
+
+
+@pytest.fixture
+def fake_chat(monkeypatch):
+    chat = FakeChat()
+    monkeypatch.setattr(ai_client, "_chat", chat)
+    return chat
@@ -0,0 +1,369 @@
+# tests/test_ai_client.py
+import json, os, subprocess, sys, time
+import pytest
+import requests
+import ai_client
+
+
+def _response(url, status, body):
+    r = requests.Response()
+    r.status_code = status
+    r.reason = "Not Found" if status == 404 else "Error" if status >= 400 else "OK"
+    r.url = url
+    r._content = json.dumps(body).encode("utf-8")
+    return r
+
+
+# ---------- HTTP session ----------
+
+def test_post_retries_never_replay_a_generation():
+    retry = ai_client.SESSION.get_adapter("http://localhost").max_retries
+    assert retry.read is False
+    assert set(retry.status_forcelist) == {503}
+
+
+# ---------- reply cache ----------
+
+def test_identical_requests_hit_the_cache(fake_chat):
+    first = ai_client.json_reply("sys", "user", model="m")
+    assert ai_client.json_reply("sys", "user", model="m") == first
+    assert len(fake_chat.calls) == 1
+
+    ai_client.json_reply("sys", "other", model="m")
+    ai_client.json_reply("sys", "user", model="other-model")
+    assert len(fake_chat.calls) == 3
+
+
+def test_cached_replies_are_copies(fake_chat):
+    fake_chat.replies = ['{"a": [1]}']
+    ai_client.json_reply("sys", "user")["a"].append(2)
+    assert ai_client.json_reply("sys", "user") == {"a": [1]}
+
+
+def test_cache_evicts_least_recently_used(fake_chat, monkeypatch):
+    monkeypatch.setattr(ai_client, "_CACHE_MAX", 2)
+    ai_client.json_reply("sys", "a")
+    ai_client.json_reply("sys", "b")
+    ai_client.json_reply("sys", "a")  # refresh a
+    ai_client.json_reply("sys", "c")  # evicts b
+    assert len(fake_chat.calls) == 3
+    ai_client.json_reply("sys", "a")
+    assert len(fake_chat.calls) == 3
+    ai_client.json_reply("sys", "b")
+    assert len(fake_chat.calls) == 4
+
+
+def test_cache_false_always_asks_the_model(fake_chat):
+    ai_client.json_reply("sys", "user")
+    ai_client.json_reply("sys", "user", cache=False)
+    ai_client.json_reply("sys", "user", cache=False)
+    assert len(fake_chat.calls) == 3
+    fake_chat.replies = ['{"fresh": true}']
+    ai_client.json_reply("sys", "new", cache=False)
+    ai_client.json_reply("sys", "new")  # fresh replies are not stored
+    assert len(fake_chat.calls) == 5
+
+
+def test_cache_max_zero_disables_cache(fake_chat, monkeypatch):
+    monkeypatch.setattr(ai_client, "_CACHE_MAX", 0)
+    ai_client.json_reply("sys", "user")
+    ai_client.json_reply("sys", "user")
+    assert len(fake_chat.calls) == 2
+
+
+# ---------- _strip_fences / _coerce_json ----------
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": 1}', '{"a": 1}'),
+    ('```json\n{"a": 1}\n```', '{"a": 1}'),
+    ('```JSON {"a": 1}```', '{"a": 1}'),
+    ('```\n[1, 2]\n```', '[1, 2]'),
+    ('  plain text  ', 'plain text'),
+])
+def test_strip_fences(text, expected):
+    assert ai_client._strip_fences(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": 1}', {"a": 1}),
+    ('[1, 2]', [1, 2]),
+    ('```json\n{"a": {"b": [1]}}\n```', {"a": {"b": [1]}}),
+    ('Sure! Here it is: {"a": "b}"} hope that helps {x}', {"a": "b}"}),
+    ('{"esc": "quote \\" and brace }"} trailing', {"esc": 'quote " and brace }'}),
+])
+def test_coerce_json(text, expected):
+    assert ai_client._coerce_json(text) == expected
+
+
+def test_coerce_json_passes_through_non_strings():
+    data = {"already": "parsed"}
+    assert ai_client._coerce_json(data) is data
+
+
+@pytest.mark.parametrize("text", ["no json here", "{not json}", "```json\n```", ""])
+def test_coerce_json_raises_value_error(text):
+    with pytest.raises(ValueError, match="Model did not return JSON"):
+        ai_client._coerce_json(text)
+
+
+# ---------- _messages_to_prompt ----------
+
+def _old_messages_to_prompt(messages):
+    # The implementation before the single-accumulator rewrite
+    sys = "\n".join(m["content"] for m in messages if m.get("role") == "system")
+    convo = []
+    for m in messages:
+        role = m.get("role")
+        if role == "user":
+            convo.append(f"User: {m['content']}")
+        elif role == "assistant":
+            convo.append(f"Assistant: {m['content']}")
+    convo.append("Assistant:")
+    return (f"[System]\n{sys}\n\n" if sys else "") + "\n".join(convo)
+
+
+@pytest.mark.parametrize("messages", [
+    [],
+    [{"role": "system", "content": "S"}],
+    [{"role": "system", "content": ""}, {"role": "user", "content": "u"}],
+    [{"role": "system", "content": "a"}, {"role": "system", "content": "b"},
+     {"role": "user", "content": "u"}, {"role": "assistant", "content": "x"},
+     {"role": "tool", "content": "ignored"}, {"role": "user", "content": "v"}],
+])
+def test_messages_to_prompt_matches_previous_output(messages):
+    assert ai_client._messages_to_prompt(messages) == _old_messages_to_prompt(messages)
+
+
+# ---------- /api/chat -> /api/generate fallback ----------
+
+def test_chat_404_falls_back_to_generate_and_is_remembered(monkeypatch):
+    calls = []
+
+    def fake_post(url, data=None, timeout=None):
+        calls.append(url.rsplit("/", 1)[-1])
+        if url.endswith("/api/chat"):
+            return _response(url, 404, {"error": "not found"})
+        return _response(url, 200, {"response": '{"via": "generate"}'})
+    monkeypatch.setattr(ai_client.SESSION, "post", fake_post)
+
+    messages = [{"role": "user", "content": "hi"}]
+    assert ai_client._chat(messages, model="m") == '{"via": "generate"}'
+    assert calls == ["chat", "generate"]
+    assert ai_client._ENDPOINT_CACHE[(ai_client.OLLAMA_HOST, "m")] == "generate"
+
+    ai_client._chat(messages, model="m")
+    assert calls == ["chat", "generate", "generate"]
+
+
+def test_chat_success_is_remembered(monkeypatch):
+    def fake_post(url, data=None, timeout=None):
+        assert url.endswith("/api/chat")
+        return _response(url, 200, {"message": {"role": "assistant", "content": "hello"}})
+    monkeypatch.setattr(ai_client.SESSION, "post", fake_post)
+
+    assert ai_client._chat([{"role": "user", "content": "hi"}], model="m") == "hello"
+    assert ai_client._ENDPOINT_CACHE[(ai_client.OLLAMA_HOST, "m")] == "chat"
+
+
+def test_chat_other_errors_bubble_up(monkeypatch):
+    def fake_post(url, data=None, timeout=None):
+        assert url.endswith("/api/chat"), "no fallback on a real server error"
+        return _response(url, 500, {"error": "boom"})
+    monkeypatch.setattr(ai_client.SESSION, "post", fake_post)
+
+    with pytest.raises(requests.HTTPError) as exc:
+        ai_client._chat([{"role": "user", "content": "hi"}], model="m")
+    assert exc.value.response.status_code == 500
+    assert (ai_client.OLLAMA_HOST, "m") not in ai_client._ENDPOINT_CACHE
+
+
+# ---------- json_reply_many ----------
+
+def test_json_reply_many_keeps_order(fake_chat):
+    pairs = [("sys", f"record {i}") for i in range(5)]
+    assert ai_client.json_reply_many(pairs) == [{"prompt": f"record {i}"} for i in range(5)]
+    assert len(fake_chat.calls) == 5
+
+
+def test_json_reply_many_skips_semantic_cache(fake_chat, monkeypatch):
+    monkeypatch.setattr(ai_client, "SEMCACHE", True)
+
+    def no_embedding(text):
+        raise AssertionError("batch calls must not use the semantic cache")
+    monkeypatch.setattr(ai_client, "_embed", no_embedding)
+
+    pairs = [("sys", f"record {i}") for i in range(3)]
+    assert ai_client.json_reply_many(pairs) == [{"prompt": f"record {i}"} for i in range(3)]
+
+
+# ---------- Harmony extraction ----------
+
+@pytest.mark.parametrize("content, expected", [
+    ("plain", "plain"),
+    ([{"type": "output_text", "text": "a"}, {"type": "json", "json": {"k": 1}},
+      {"type": "json", "json": {"k": 2}}], '{"k":1}'),
+    ([{"type": "json", "json": None}, {"type": "json", "json": [1]}], "[1]"),
+    (["junk", {"type": "output_text", "text": "a"}, {"type": "text", "content": "b"}], "ab"),
+    ([{"type": "reasoning", "content": "hidden"}], ""),
+])
+def test_extract_from_harmony_message(content, expected):
+    out = ai_client._extract_from_harmony_message({"content": content})
+    if expected.startswith(("{", "[")):
+        assert json.loads(out) == json.loads(expected)
+    else:
+        assert out == expected
+
+
+def test_harmony_json_block_that_cannot_be_serialized_falls_back_to_text():
+    content = [{"type": "json", "json": {1j}}, {"type": "output_text", "text": "fallback"}]
+    assert ai_client._extract_from_harmony_message({"content": content}) == "fallback"
+
+
+def test_harmony_top_level_text_keys():
+    assert ai_client._extract_from_harmony_message({"content": None, "response": "r"}) == "r"
+
+
+# ---------- validator retry ----------
+
+def _require_email(data):
+    if "email" not in data:
+        raise ValueError("'email' is a required property")
+
+
+def test_valid_reply_is_not_retried(fake_chat):
+    fake_chat.replies = ['{"email": "a@b.c"}']
+    assert ai_client.json_reply("sys", "user", validator=_require_email) == {"email": "a@b.c"}
+    assert len(fake_chat.calls) == 1
+
+
+def test_invalid_reply_is_retried_once_with_the_reason(fake_chat):
+    fake_chat.replies = ['{"name": "x"}', '{"email": "a@b.c"}']
+    assert ai_client.json_reply("sys", "user", validator=_require_email) == {"email": "a@b.c"}
+    assert len(fake_chat.calls) == 2
+    assert "'email' is a required property" in fake_chat.calls[1][-1]["content"]
+    # the valid retry answer is what gets cached
+    assert ai_client.json_reply("sys", "user", validator=_require_email) == {"email": "a@b.c"}
+    assert len(fake_chat.calls) == 2
+
+
+def test_invalid_retry_raises_and_is_not_cached(fake_chat):
+    fake_chat.replies = ['{"name": "x"}', '{"name": "y"}', '{"email": "a@b.c"}']
+    with pytest.raises(ValueError, match="required property"):
+        ai_client.json_reply("sys", "user", validator=_require_email)
+    assert ai_client.json_reply("sys", "user") == {"email": "a@b.c"}
+    assert len(fake_chat.calls) == 3
+
+
+# ---------- object scanner (chatter around the JSON) ----------
+
+@pytest.mark.parametrize("text, expected", [
+    ('noise {bad} then {"a": 1}', {"a": 1}),
+    ('x { never closed {"b": 2}', {"b": 2}),
+    ('outer {"a": {"b": 1}} wins', {"a": {"b": 1}}),
+    ('It\'s "quoted" prose: {"a": "}"}', {"a": "}"}),
+])
+def test_coerce_json_skips_invalid_blocks(text, expected):
+    assert ai_client._coerce_json(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    ("{ lorem ipsum dolor " * 1000) + "x" * 30000 + '{"a": 1}',  # 1,000 unclosed braces
+    "{" * 10000 + "x" + "}" * 10000,                              # deep balanced junk
+    '{"a":' * 5000 + "x" + "}" * 5000,                            # deep valid-looking prefix
+])
+def test_coerce_json_stays_linear_on_pathological_chatter(text):
+    started = time.perf_counter()
+    try:
+        ai_client._coerce_json(text)
+    except ValueError:
+        pass
+    assert time.perf_counter() - started < 0.5
+
+
+
+# ---------- semantic cache ----------
+
+class FakeEmbeddings:
+    """Serves /api/embeddings from a text -> vector dict and records requests."""
+
+    def __init__(self):
+        self.vectors = {}
+        self.requested = []
+
+    def __call__(self, url, data=None, timeout=None):
+        assert url == ai_client._EMBED_URL
+        prompt = json.loads(data)["prompt"]
+        self.requested.append(prompt)
+        return _response(url, 200, {"embedding": self.vectors[prompt]})
+
+
+@pytest.fixture
+def embeddings(monkeypatch):
+    np = pytest.importorskip("numpy")
+    monkeypatch.setattr(ai_client, "np", np, raising=False)
+    monkeypatch.setattr(ai_client, "SEMCACHE", True)
+    fake = FakeEmbeddings()
+    monkeypatch.setattr(ai_client.SESSION, "post", fake)
+    return fake
+
+
+def test_semantic_hit_reuses_reply_within_scope(fake_chat, embeddings):
+    embeddings.vectors = {"country=AT": [1.0, 0.0, 0.0], "country=Austria": [0.99, 0.05, 0.0]}
+    first = ai_client.json_reply("sys", "prompt AT", semantic=("user_profile", "country=AT"))
+    second = ai_client.json_reply("sys", "prompt Austria", semantic=("user_profile", "country=Austria"))
+    assert second == first
+    assert len(fake_chat.calls) == 1
+    # the semantic hit is promoted to the exact cache: no second embedding
+    ai_client.json_reply("sys", "prompt Austria", semantic=("user_profile", "country=Austria"))
+    assert embeddings.requested == ["country=AT", "country=Austria"]
+
+
+def test_semantic_miss_below_threshold_or_other_scope(fake_chat, embeddings):
+    embeddings.vectors = {"country=AT": [1.0, 0.0], "country=DE": [0.7, 0.7]}
+    ai_client.json_reply("sys", "prompt AT", semantic=("user_profile", "country=AT"))
+    ai_client.json_reply("sys", "prompt DE", semantic=("user_profile", "country=DE"))
+    ai_client.json_reply("sys", "prompt AT order", semantic=("order", "country=AT"))
+    assert len(fake_chat.calls) == 3
+
+
+def test_semantic_layer_skipped_without_variable_text(fake_chat, embeddings):
+    ai_client.json_reply("sys", "prompt", semantic=("user_profile", ""))
+    ai_client.json_reply("sys", "prompt 2")
+    assert embeddings.requested == []
+    assert len(fake_chat.calls) == 2
+
+
+def test_empty_embedding_is_not_stored(fake_chat, embeddings):
+    embeddings.vectors = {"x": [], "country=AT": [1.0, 0.0]}
+    ai_client.json_reply("sys", "p1", semantic=("user_profile", "x"))
+    ai_client.json_reply("sys", "p2", semantic=("user_profile", "country=AT"))
+    assert len(fake_chat.calls) == 2
+    assert ai_client._SEM_CACHE[(ai_client.MODEL, "sys", "user_profile")][0].shape == (1, 2)
+
+
+def test_dimension_change_is_a_miss_and_not_mixed(fake_chat, embeddings):
+    embeddings.vectors = {"a": [1.0, 0.0, 0.0], "b": [1.0, 0.0, 0.0, 0.0]}
+    ai_client.json_reply("sys", "p1", semantic=("user_profile", "a"))
+    ai_client.json_reply("sys", "p2", semantic=("user_profile", "b"))
+    assert len(fake_chat.calls) == 2
+    assert ai_client._SEM_CACHE[(ai_client.MODEL, "sys", "user_profile")][0].shape == (1, 3)
+
+
+def test_embedding_failure_falls_back_to_the_model(fake_chat, embeddings):
+    embeddings.vectors = {}  # KeyError inside the stub -> request fails
+    assert ai_client.json_reply("sys", "p", semantic=("user_profile", "a")) == {"prompt": "p"}
+
+
+def test_semcache_without_numpy_disables_itself_instead_of_failing_import(tmp_path):
+    pytest.importorskip("robot")
+    script = (
+        "import sys; sys.modules['numpy'] = None\n"  # makes 'import numpy' raise ImportError
+        "import ai_client, AILogListener\n"
+        "print('SEMCACHE', ai_client.SEMCACHE)\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, AI_SEMCACHE="1", PYTHONPATH=root)
+    out = subprocess.run([sys.executable, "-c", script], env=env, cwd=tmp_path,
+                         capture_output=True, text=True, check=True)
+    assert "SEMCACHE False" in out.stdout
+    assert "needs numpy" in out.stdout + out.stderr
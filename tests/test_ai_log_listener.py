@@ -0,0 +1,136 @@
+# tests/test_ai_log_listener.py
+import pytest
+
+pytest.importorskip("robot")
+from robot import running
+from robot.result import TestSuite as ResultSuite
+import AILogListener as mod
+from AILogListener import AILogListener
+
+
+class Recorder:
+    """Stands in for both _chat and robot's logger inside AILogListener."""
+
+    def __init__(self):
+        self.prompts = []
+        self.warnings = []
+        self.console = []
+
+    def chat(self, messages, model=None, temperature=0.2):
+        self.prompts.append(messages[-1]["content"])
+        return "analysis"
+
+    def warn(self, msg):
+        self.warnings.append(msg)
+
+    def debug(self, msg):
+        pass
+
+
+@pytest.fixture
+def rec(monkeypatch):
+    rec = Recorder()
+    monkeypatch.setattr(mod, "_chat", rec.chat)
+    monkeypatch.setattr(mod.logger, "warn", rec.warn)
+    monkeypatch.setattr(mod.logger, "debug", rec.debug)
+    monkeypatch.setattr(mod.logger, "console", rec.console.append)
+    return rec
+
+
+def failed_test(tags=("AI_ANALYZE",), message="boom", steps=(), status="FAIL"):
+    suite = ResultSuite(name="S")
+    test = suite.tests.create(name="T", tags=list(tags), status=status, message=message)
+    for name, kw_status in steps:
+        test.body.create_keyword(name=name, args=("a", "b"), status=kw_status)
+    return test
+
+
+def analyze(listener, test):
+    listener.end_test(None, test)
+    listener.close()
+
+
+# ---------- tag gating ----------
+
+@pytest.mark.parametrize("configured, test_tag", [
+    ("AI_ANALYZE", "AI_ANALYZE"),
+    ("ai_analyze", "AI_ANALYZE"),
+    ("AI_ANALYZE", "ai analyze"),
+    ("ai analyze, other", "AiAnalyze"),
+])
+def test_tags_match_like_robot(rec, configured, test_tag):
+    analyze(AILogListener(tags=configured), failed_test(tags=[test_tag]))
+    assert len(rec.prompts) == 1
+
+
+def test_untagged_and_passing_tests_are_skipped(rec):
+    listener = AILogListener(tags="AI_ANALYZE")
+    listener.end_test(None, failed_test(tags=["smoke"]))
+    listener.end_test(None, failed_test(status="PASS"))
+    listener.close()
+    assert rec.prompts == []
+
+
+def test_empty_tag_filter_analyzes_every_failure(rec):
+    analyze(AILogListener(tags=""), failed_test(tags=[]))
+    assert len(rec.prompts) == 1
+
+
+# ---------- failing steps ----------
+
+def test_steps_come_from_the_result_model_in_order(rec):
+    test = failed_test(steps=[("Open Page", "PASS"), ("Click", "PASS"), ("Check", "FAIL")])
+    test.body.create_message("not a keyword")
+    analyze(AILogListener(), test)
+    prompt = rec.prompts[0]
+    assert "- Open Page  a  b  -> PASS\n- Click  a  b  -> PASS\n- Check  a  b  -> FAIL" in prompt
+    assert "not a keyword" not in prompt
+
+
+def test_max_steps_zero_sends_no_steps(rec):
+    analyze(AILogListener(max_steps="0"), failed_test(steps=[("Check", "FAIL")]))
+    assert "Check" not in rec.prompts[0]
+
+
+# ---------- background analysis ----------
+
+def test_workers_must_be_positive():
+    with pytest.raises(ValueError, match="workers must be at least 1"):
+        AILogListener(workers="0")
+
+
+def test_analysis_is_reported_when_the_top_suite_ends(rec):
+    listener = AILogListener()
+    listener.end_test(None, failed_test())
+    top = running.TestSuite(name="S")
+    listener.end_suite(top, None)
+    assert rec.warnings == ["AI analysis for 'S.T':\nanalysis"]
+    assert "AI Failure Analysis: S.T" in rec.console[0]
+    listener.close()
+    assert len(rec.warnings) == 1
+
+
+def test_chat_errors_are_reported_not_raised(rec, monkeypatch):
+    def broken(messages, model=None, temperature=0.2):
+        raise RuntimeError("ollama down")
+    monkeypatch.setattr(mod, "_chat", broken)
+    analyze(AILogListener(), failed_test())
+    assert rec.warnings == ["AI listener failed for 'S.T': RuntimeError('ollama down')"]
+
+
+def test_only_the_last_max_steps_are_sent(rec):
+    steps = [(f"Step {i}", "PASS") for i in range(20)]
+    analyze(AILogListener(max_steps="3"), failed_test(steps=steps))
+    prompt = rec.prompts[0]
+    assert "Step 16" not in prompt
+    assert all(f"Step {i}  a  b" in prompt for i in (17, 18, 19))
+
+
+# ---------- prompt size ----------
+
+def test_long_messages_keep_their_tail(rec):
+    message = "x" * 10_000 + "THE END"
+    analyze(AILogListener(max_chars="500"), failed_test(message=message))
+    prompt = rec.prompts[0]
+    assert len(prompt) <= 500
+    assert "THE END" in prompt
@@ -0,0 +1,102 @@
+# tests/test_ai_test_data.py
+import json
+import pytest
+import ai_client
+
+pytest.importorskip("robot")
+import AITestData as mod
+from AITestData import AITestData
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    monkeypatch.setattr(ai_client, "OFFLINE", True)  # any cache miss fails loudly
+
+
+def _fixture(tmp_path, records):
+    path = tmp_path / "users.jsonl"
+    path.write_text("".join(json.dumps(r) + "\n" for r in records) + "\n", encoding="utf-8")
+    return str(path)
+
+
+# ---------- preload / offline ----------
+
+def test_cache_reply_round_trip_skips_the_model(offline, monkeypatch):
+    monkeypatch.setattr(ai_client, "_CACHE_MAX", 0)  # pinned entries don't depend on the LRU
+    assert ai_client.cache_reply("sys", "user", {"a": [1]}, model="m") is True
+    assert ai_client.cache_reply("sys", "user", {"a": [2]}, model="m") is False
+
+    reply = ai_client.json_reply("sys", "user", model="m")
+    assert reply == {"a": [2]}
+    reply["a"].append(3)  # callers get a copy
+    assert ai_client.json_reply("sys", "user", model="m") == {"a": [2]}
+
+
+def test_offline_miss_raises_without_any_request(offline):
+    with pytest.raises(RuntimeError, match="AI_OFFLINE=1"):
+        ai_client.json_reply("sys", "user")
+
+
+def test_preloaded_record_serves_generate_test_data(offline, tmp_path, monkeypatch):
+    monkeypatch.setattr(ai_client, "_CACHE_MAX", 0)
+    user = {"first_name": "Anna", "last_name": "Gruber", "email": "anna@example.at", "password": "x"}
+    path = _fixture(tmp_path, [
+        {"type": "user_profile", "constraints": {"password_policy": "strong", "country": "AT"}, "data": user},
+    ])
+    lib = AITestData(model="m")
+
+    assert lib.preload_test_data(path) == 1
+    # keyword argument order doesn't matter for the lookup
+    assert lib.generate_test_data(type="user_profile", country="AT", password_policy="strong") == user
+
+
+def test_preload_counts_distinct_records(offline, tmp_path):
+    path = _fixture(tmp_path, [
+        {"type": "user_profile", "constraints": {"country": "AT"}, "data": {"n": 1}},
+        {"type": "user_profile", "constraints": {"country": "AT"}, "data": {"n": 2}},
+        {"type": "user_profile", "constraints": {"country": "DE"}, "data": {"n": 3}},
+    ])
+    lib = AITestData(model="m")
+
+    assert lib.preload_test_data(path) == 2
+    assert lib.generate_test_data(country="AT") == {"n": 2}
+    assert lib.generate_test_data(country="DE") == {"n": 3}
+
+
+def test_preloaded_batch_records_serve_generate_test_data_batch(offline, tmp_path):
+    path = _fixture(tmp_path, [
+        {"type": "user_profile", "constraints": {"country": "AT"}, "index": i, "n": 3, "data": {"i": i}}
+        for i in (1, 2, 3)
+    ])
+    lib = AITestData(model="m")
+
+    assert lib.preload_test_data(path) == 3
+    assert lib.generate_test_data_batch(3, country="AT") == [{"i": 1}, {"i": 2}, {"i": 3}]
+    with pytest.raises(RuntimeError, match="AI_OFFLINE=1"):
+        lib.generate_test_data_batch(2, country="AT")  # a different batch size is a different prompt
+
+
+def test_warmup_writes_fixtures_that_preload_offline(fake_chat, tmp_path, monkeypatch):
+    out = str(tmp_path / "fixtures" / "users.jsonl")
+    mod._warmup(["type=user_profile", "country=AT", "-o", out])
+    mod._warmup(["type=user_profile", "country=AT", "-n", "2", "-o", out])
+    assert len(fake_chat.calls) == 3
+
+    monkeypatch.setattr(ai_client, "_REPLY_CACHE", ai_client.OrderedDict())
+    monkeypatch.setattr(ai_client, "OFFLINE", True)
+    lib = AITestData()
+    assert lib.preload_test_data(out) == 3
+    assert "prompt" in lib.generate_test_data(country="AT")
+    assert len(lib.generate_test_data_batch(2, country="AT")) == 2
+    assert len(fake_chat.calls) == 3
+
+
+# ---------- caching per call ----------
+
+def test_generate_test_data_is_cached_unless_fresh(fake_chat):
+    lib = AITestData()
+    first = lib.generate_test_data(country="AT")
+    assert lib.generate_test_data(country="AT") == first
+    assert len(fake_chat.calls) == 1
+    lib.generate_test_data(country="AT", fresh=True)
+    assert len(fake_chat.calls) == 2